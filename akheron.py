@@ -10,10 +10,12 @@ import cmd
 import functools
 import operator
 import os.path
+import re
+import sys
 import threading
 from enum import Enum, auto
 from typing import NamedTuple
-from time import sleep
+from time import monotonic
 
 import serial
 from serial.tools.list_ports import comports
@@ -42,10 +44,24 @@ class TextRangeDisplayMode(NamedTuple):
     end: int
     mode: str
 
+# Per-port state used while passing traffic, see 'portStates'.
+class PortState:
+    __slots__ = ("msg_buffer", "out_buffer", "matched_end")
+
+    def __init__(self):
+        # Incoming (RX'd) data to check against msgDelims.
+        self.msg_buffer = bytearray()
+        # Incoming (RX'd) data held back until a message delimiter is matched.
+        self.out_buffer = bytearray()
+        # End-of-message delim matched by the last byte checked in the previous chunk of data.
+        self.matched_end = b""
+
 # Globals #####
 version = "0.2"
 histfile = os.path.join(os.path.expanduser("~"), ".akheron_history")
 histsize = 1000
+# Display strings for every byte value, so traffic doesn't need to be formatted byte-by-byte.
+hexByteStrs = tuple("0x%02x " % i for i in range(256))
 ansi_text = {
     "reset":     "\033[0m",
     "bold":      "\033[1m",
@@ -65,14 +81,37 @@ portSettings = {
     }
 }
 
-# Delimiters for start-of-message and end-of-message, as provided via 'delimset' command.
+# Results of the last serial port scan for the 'list' command, as (scan time, sorted ports), since scanning
+# is relatively slow; reused for 'portListCacheTtl' seconds.
+portListCache = (0.0, [])
+portListCacheTtl = 2.0
+
+# Delimiters (as bytes) for start-of-message and end-of-message, as provided via 'delimset' command.
 msgDelims = {
     "start": [],
     "end": []
 }
 delimMatching = False
 
-# Pattern replacement/substitution, as provided via the 'replaceset' command.
+# Pre-formatted display strings for each message delimiter, keyed by the delimiter.
+msgDelimsDisplay = {
+    "start": {},
+    "end": {}
+}
+
+# All the message delimiters of each type (in the order listed), for checking against them all at once.
+msgDelimsPatterns = {
+    "start": (),
+    "end": ()
+}
+# All start-of-message and end-of-message delims compiled into one regex, used to find where
+# a delim could possibly match in the RX'd data. Regenerated on each 'delimset'.
+delimRegex = None
+# When every delim is a single byte, a bytes.translate() table marking the delim bytes with 1 (and every
+# other byte with 0), used instead of 'delimRegex' since finding a marked byte is much quicker.
+delimByteMarks = None
+
+# Pattern replacement/substitution (pattern X bytes -> pattern Y bytes), as provided via the 'replaceset' command.
 replacePatterns = {
     "A": {},
     "B": {}
@@ -95,22 +134,26 @@ textMode = {
     "replaced": "none"
 }
 
-# Temp buffers for holding incoming (RX'd) data to check against msgDelims.
-checkMsgBuffers = {
-    "A": [],
-    "B": []
+# Per-port traffic state (message buffers and delim matches), reset on each 'start'.
+portStates = {
+    "A": PortState(),
+    "B": PortState()
 }
 checkMsgBufferMax = 0
 
 # When capturing to an external file
 captureFile = None
-captureFileSize = 0
+# Captured output not yet written to captureFile, written out once per received chunk (or when it gets big).
+captureBuffer = bytearray()
+captureBufferMax = 64 * 1024
 captureStarted = False
 
 trafficPassing = False
 
 watching = False
 watchingStarted = False
+# Set when watch mode is exited, so waiting on it doesn't need to poll 'watching'.
+watchExited = threading.Event()
 
 # Resource locks
 writerLock = {
@@ -138,12 +181,19 @@ Akheron Proxy, UART proxy tool for inter-chip analysis
 #   '-v': enable verbose listing of more details
 # Returns: n/a
 def list_serial_ports(args=""):
+    global portListCache
+
     if len(args) == 1 and args[0] == "-v":
         verbose = True
     else:
         verbose = False
 
-    iterator = sorted(comports())
+    now = monotonic()
+    if portListCache[1] and now - portListCache[0] < portListCacheTtl:
+        iterator = portListCache[1]
+    else:
+        iterator = sorted(comports())
+        portListCache = (now, iterator)
     for n, port_info in enumerate(iterator):
         print("{}".format(port_info.device))
         if verbose:
@@ -196,6 +246,10 @@ def port_set(args=""):
     portSettings[port]["dev"] = device_name
     portSettings[port]["baud"] = int(baud)
 
+    # Devices may have come or gone since the last 'list', rescan next time.
+    global portListCache
+    portListCache = (0.0, [])
+
     # Warn if we're setting the port to the same device as the other port, as that's likely not wanted...
     if port == "A":
         other_port = "B"
@@ -213,7 +267,7 @@ def delim_get(args=""):
         print("%5s delimiters: " % d, end="")
         if msgDelims[d]:
             for e in msgDelims[d]:
-                print(" ".join(format("0x%02x" % int(n, 16)) for n in e) + ", ", end="")
+                print(msgDelimsDisplay[d][e] + ", ", end="")
             print("\b\b ", end="")
         print()
 
@@ -227,6 +281,8 @@ def delim_get(args=""):
 # Returns: n/a
 def delim_set(args=""):
     global msgDelims
+    global delimRegex
+    global delimByteMarks
 
     if len(args) < 1:
         print("Incorrect number of args, type \"help\" for usage")
@@ -242,13 +298,27 @@ def delim_set(args=""):
     if setting_type != "start" and setting_type != "end":
         print("Invalid \"start/end\" value, type \"help\" for usage")
         return
+    try:
+        delims = [bytes(int(j, 16) for j in i.split(" ") if len(j) > 0) for i in values]
+    except ValueError:
+        print("Invalid delim value provided, type \"help\" for usage")
+        return
     msgDelims[setting_type] = []
-    for i in values:
-        delim = []
-        for j in i.split(" "):
-            if len(j) > 0:
-                delim.append(hex(int(j, 16)))
+    msgDelimsDisplay[setting_type] = {}
+    for delim in delims:
         msgDelims[setting_type].append(delim)
+        # Delimiters don't change until the next 'delimset', so format them for display just once.
+        msgDelimsDisplay[setting_type][delim] = " ".join("0x%02x" % n for n in delim)
+    msgDelimsPatterns[setting_type] = tuple(msgDelims[setting_type])
+
+    delimRegex = None
+    all_delims = msgDelims["start"] + msgDelims["end"]
+    if all_delims:
+        delimRegex = re.compile(b"|".join(re.escape(d) for d in all_delims))
+    delimByteMarks = None
+    if all_delims and all(len(d) == 1 for d in all_delims):
+        delim_bytes = b"".join(all_delims)
+        delimByteMarks = bytes(1 if i in delim_bytes else 0 for i in range(256))
 
 
 # Apply serial port device settings before executing sniffing/replay operations.
@@ -285,8 +355,7 @@ def replace_get(args=""):
     for p in ["A", "B"]:
         print("Replace port %c pattern X -> pattern Y:" % p)
         for r in replacePatterns[p]:
-            print("  %s -> %s" % (str(" ".join(format("0x%02x" % int(n, 16)) for n in r.split(" "))),
-                    str(" ".join(format("0x%02x" % int(n, 16)) for n in replacePatterns[p][r]))))
+            print("  %s -> %s" % (" ".join("0x%02x" % n for n in r), " ".join("0x%02x" % n for n in replacePatterns[p][r])))
 
 
 # 'replaceset' command, allows user to set "substitute pattern-X-for-Y" values.
@@ -322,13 +391,18 @@ def replace_set(args=""):
             continue
         pattern = {}
         index = 0
-        for p in ["LHS", "RHS"]:
-            pattern[p] = []
-            for k in lhs_rhs_list[index].split(" "):
-                if len(k) > 0:
-                    pattern[p].append(hex(int(k, 16)))
-            index += 1
-        replacePatterns[port][" ".join(pattern["LHS"])] = pattern["RHS"]
+        try:
+            for p in ["LHS", "RHS"]:
+                pattern[p] = bytes(int(k, 16) for k in lhs_rhs_list[index].split(" ") if len(k) > 0)
+                index += 1
+        except ValueError:
+            print("Invalid replace pattern provided, skipping \"%s\"" % i)
+            continue
+        if len(pattern["LHS"]) == 0:
+            # An empty pattern would "match" everywhere, endlessly.
+            print("Invalid replace pattern provided, skipping \"%s\"" % i)
+            continue
+        replacePatterns[port][pattern["LHS"]] = pattern["RHS"]
 
 
 # 'checksumget' command, allows user to output the current checksum recalculation used after pattern replacements
@@ -396,13 +470,12 @@ def replace_patterns_if_matched(data, patterns, replaceChecksumOptions, port):
         return data, None
     updated_text_mode_ranges = []
     for k, v in patterns.items():
-        k_list = k.split(" ")
-        match_list = [int(i, 16) for i in k_list]
+        match_list = list(k)
         len_ml = len(match_list)
         i = 0
         while i < (len(data) - len_ml + 1):
             if match_list == data[i:i + len_ml]:
-                data[i:i + len_ml] = [int(val, 16) for val in v]
+                data[i:i + len_ml] = list(v)
                 if textMode["replaced"] != "none":
                     # Start index, stop index, and the text mode to use for this range...
                     updated_text_mode_ranges.append(TextRangeDisplayMode(i, i + len_ml, textMode["replaced"]))
@@ -426,13 +499,12 @@ def replace_patterns_if_matched(data, patterns, replaceChecksumOptions, port):
 def find_position_after_start_delimiter(data, port):
     idx_after_delim = 0
     for delim in msgDelims["start"]:
-        delim_ints = [int(i, 16) for i in delim]
-        if len(data) < len(delim_ints):
+        if len(data) < len(delim):
             # data doesn't contain enough bytes to compare with the delimiter pattern
             continue
-        elif data[0:len(delim_ints)] == delim_ints:
+        elif data[0:len(delim)] == list(delim):
             # data matches a start delimiter pattern
-            idx_after_delim = len(delim_ints)
+            idx_after_delim = len(delim)
             break
     return idx_after_delim
 
@@ -455,61 +527,79 @@ def calculate_checksum(data, checksum_method):
     return value
 
 
-# Check a received set of bytes for a match to a start-of-message or end-of-message delim.
-# port: indicates which port ("A" or "B") delimiters should be used for this check
-# startOrEnd: indicates if the "start" or "end" message delimiters should be checked.
+# Check a received set of bytes for a match to a start-of-message delim or, failing that, an
+#   end-of-message delim.
+# state: PortState of the port the byte was received on
 # byte: new byte of data received
-# Returns: matched string (delim) value OR an empty string if no match
-def check_msg(port, start_or_end, byte=None):
+# start_delims/end_delims: the start-of-message/end-of-message delims to check, from 'msgDelimsPatterns'
+# Returns: (matched start-of-message delim, matched end-of-message delim), at most one of which is
+#   set; unmatched ones are empty bytes
+def check_msg(state, byte, start_delims, end_delims):
     global checkMsgBufferMax
 
-    matched_str = ""
     if checkMsgBufferMax > 0:
-        if byte:
-            if len(checkMsgBuffers[port]) == checkMsgBufferMax:
-                # Our message buffer is full, remove the oldest char.
-                checkMsgBuffers[port].pop(0)
-            checkMsgBuffers[port].append(hex(byte))
-        for i in msgDelims[start_or_end]:
-            cmp_start_index = 0
-            if len(checkMsgBuffers[port]) < len(i):
-                # Not enough bytes in buffer to compare with delim pattern
-                continue
-            elif len(checkMsgBuffers[port]) > len(i):
-                # Compare the correct length of the delim pattern to match on
-                cmp_start_index = len(checkMsgBuffers[port]) - len(i)
-            if checkMsgBuffers[port][cmp_start_index:] == i:
-                # Matched a delimiter!
-                checkMsgBuffers[port] = []
-                matched_str = i
-                break
-    return matched_str
+        state.msg_buffer.append(byte)
+        if len(state.msg_buffer) >= 2 * checkMsgBufferMax:
+            # Only the newest checkMsgBufferMax bytes can match, so drop the older ones (in one go
+            # every so often, rather than shifting the whole buffer along for every byte).
+            del state.msg_buffer[:-checkMsgBufferMax]
+        # Check against all the delims of a type in one go, only working out which one matched if any did.
+        if state.msg_buffer.endswith(start_delims):
+            for i in start_delims:
+                if state.msg_buffer.endswith(i):
+                    # Matched a delimiter!
+                    state.msg_buffer = bytearray()
+                    return i, b""
+        if state.msg_buffer.endswith(end_delims):
+            for i in end_delims:
+                if state.msg_buffer.endswith(i):
+                    # Matched a delimiter!
+                    state.msg_buffer = bytearray()
+                    return b"", i
+    return b"", b""
 
 
 # Similar to the *nix command 'tee', this method sends output to both the display
 #   and capture file, if in use.
 # string: string value to display+write
 # end: trailing character for 'string'
+# flush: flush the display output and capture file now, rather than when their buffers decide to
 # Returns: n/a
-def tee(string="", end="\n", output=TeeOutput.both):
+def tee(string="", end="\n", output=TeeOutput.both, flush=False):
     with teeLock:
-        global captureFileSize
-
         if captureFile and output != TeeOutput.onlyDisplay:
-            if len(string) > 0 and string[0] == "\b":
-                # Need to erase some previously-written bytes due to a msg delimiter.
-                if captureFileSize >= len(string):
-                    captureFileSize -= len(string)
-                else:
-                    captureFileSize = 0
-                captureFile.seek(captureFileSize, 0)
+            if "\b" not in string:
+                captureBuffer.extend((string + end).encode())
             else:
-                captureFile.write("%s%s" % (string, end))
-                captureFile.flush()
-                captureFileSize += len(string) + len(end)
+                # Split out runs of backspaces ("\x08", rather than "\b" which reads as a regex word
+                # boundary).
+                for text in re.split("(\x08+)", string + end):
+                    if text[:1] != "\x08":
+                        captureBuffer.extend(text.encode())
+                    else:
+                        # Need to erase some previously-written bytes due to a msg delimiter (these are
+                        # always still buffered, see below).
+                        del captureBuffer[-len(text):]
+            if flush or len(captureBuffer) >= captureBufferMax:
+                # Hold back enough output that a multi-byte start-of-message delim completing in a later
+                # chunk can still erase its earlier bytes, so the capture file is only ever appended to.
+                capture_flush(len(hexByteStrs[0]) * max(checkMsgBufferMax - 1, 0))
 
         if watching and output != TeeOutput.onlyFile:
-            print(string, end=end, flush=True)
+            sys.stdout.write(string + end)
+            if flush:
+                sys.stdout.flush()
+
+
+# Write out any buffered capture output to the capture file; callers must hold teeLock.
+# keep: number of the most recently buffered bytes to keep buffered
+# Returns: n/a
+def capture_flush(keep=0):
+    if len(captureBuffer) > keep:
+        write_len = len(captureBuffer) - keep
+        captureFile.write(captureBuffer[:write_len])
+        captureFile.flush()
+        del captureBuffer[:write_len]
 
 
 # Capturing traffic between two ports.
@@ -519,7 +609,6 @@ def tee(string="", end="\n", output=TeeOutput.both):
 def capture_traffic_start(args=""):
     global replacePatterns
     global captureFile
-    global captureFileSize
     global captureStarted
 
     if len(args) != 1:
@@ -531,10 +620,10 @@ def capture_traffic_start(args=""):
         return
 
     captureFile = None
-    captureFileSize = 0
+    captureBuffer.clear()
     capture_file_name = args[0]
     try:
-        captureFile = open(capture_file_name, "w")
+        captureFile = open(capture_file_name, "wb")
     except IOError as e:
         print("File \"%s\" could not be opened: %s" % (capture_file_name, str(e)))
         return
@@ -550,15 +639,15 @@ def capture_traffic_start(args=""):
 # Returns: n/a
 def capture_traffic_stop(args=""):
     global captureFile
-    global captureFileSize
     global captureStarted
 
     # Close ports and capture file, if applicable.
     captureStarted = False
     if captureFile:
-        captureFile.close()
-        captureFile = None
-        captureFileSize = 0
+        with teeLock:
+            capture_flush()
+            captureFile.close()
+            captureFile = None
         print("Capture stopped")
 
 
@@ -573,16 +662,24 @@ def dump_capture(args=""):
     dump_file_name = args[0]
 
     try:
-        dump_file = open(dump_file_name, "r")
+        dump_file = open(dump_file_name, "rb")
     except IOError as e:
         print("File \"%s\" could not be opened: %s" % (dump_file_name, str(e)))
         return
-    dump_file_contents = dump_file.readlines()
 
-    line_num = 1
-    for line in dump_file_contents:
-        print("%5u: %s" % (line_num, line.rstrip()))
-        line_num += 1
+    # Stream the file rather than reading it all in, captures can get big, and write out the
+    # numbered lines in large batches...
+    sys.stdout.flush()
+    out = sys.stdout.buffer
+    batch = bytearray()
+    with dump_file:
+        for line_num, line in enumerate(dump_file, 1):
+            batch += b"%5u: %s\n" % (line_num, line.rstrip())
+            if len(batch) >= 65536:
+                out.write(batch)
+                batch.clear()
+    out.write(batch)
+    out.flush()
 
 def updated_text_output_str(data, updated_text_mode_ranges):
     outstr = ""
@@ -594,7 +691,8 @@ def updated_text_output_str(data, updated_text_mode_ranges):
                     # Reached the start of a range of replaced text, set to colorized text...
                     outstr += ansi_text[r.mode]
                     break
-            outstr += format("0x%02x" % int(b))
+            # Display string for the byte, without its trailing space.
+            outstr += hexByteStrs[b][:-1]
             for r in updated_text_mode_ranges:
                 if r.end == index:
                     # Reached the end of a range of replaced text, reset to normal text...
@@ -603,10 +701,22 @@ def updated_text_output_str(data, updated_text_mode_ranges):
             outstr += " "
             index += 1
     else:
-        outstr = " ".join(format("0x%02x" % int(n)) for n in data) + " "
+        outstr = "".join(hexByteStrs[n] for n in data)
     return outstr
 
 
+# Parse a line of captured traffic ("0x01 0x02 ...") into byte values.
+# line: captured traffic, without any leading direction string
+# Returns: list of integers representing byte values
+def parse_replay_line(line):
+    try:
+        # Captures are written with every byte as "0x%02x", which bytes.fromhex() can handle in one go.
+        return list(bytes.fromhex(line.replace("0x", "")))
+    except ValueError:
+        # Hand-edited file maybe, parse it value-by-value instead.
+        return [int(b, 16) for b in line.split()]
+
+
 # Replaying traffic between two ports.
 # args:
 #   [0]: filename to replay captured data from
@@ -627,7 +737,8 @@ def replay_traffic(args=""):
     except IOError as e:
         print("File \"%s\" could not be opened: %s" % (replay_file_name, str(e)))
         return
-    replay_file_contents = replay_file.readlines()
+    with replay_file:
+        replay_file_contents = replay_file.readlines()
 
     lines = []
     if len(args) == 2:
@@ -642,7 +753,9 @@ def replay_traffic(args=""):
             else:
                 lines.append(int(i))
     else:
-        lines = list(range(1, len(replay_file_contents) + 1))
+        lines = range(1, len(replay_file_contents) + 1)
+    # Checked for every line of the file below, so make that a quick lookup.
+    lines = set(lines)
 
     # Apply serial port settings
     if not port_set_apply():
@@ -679,6 +792,7 @@ def replay_traffic(args=""):
         global watching
         global watchingStarted
         watching = watchingStarted = True
+        watchExited.clear()
         curr_direction = "unknown"
         line_num = 1
         for line in replay_file_contents:
@@ -687,11 +801,11 @@ def replay_traffic(args=""):
                 start_index = line.find(":") + 1
                 curr_direction = line[0:start_index - 1]
             if line_num in lines and curr_direction == direction:
-                line_data = list(map(lambda b: int(b, 16), line[start_index:].rstrip().split()))
+                line_data = parse_replay_line(line[start_index:])
                 line_data, updated_text_mode_ranges = replace_patterns_if_matched(line_data, replacePatterns[p], replaceChecksums[p], p)
                 processor.write(out_dev_id, bytes(line_data))
-                tee("\n%s: %s" % (direction, " ".join(format("0x%02x" % int(n)) for n in line_data) + " "), "", TeeOutput.onlyFile)
-                tee("\n%s: %s" % (direction, updated_text_output_str(line_data, updated_text_mode_ranges)), "", TeeOutput.onlyDisplay)
+                tee("\n%s: %s" % (direction, "".join(hexByteStrs[n] for n in line_data)), "", TeeOutput.onlyFile, True)
+                tee("\n%s: %s" % (direction, updated_text_output_str(line_data, updated_text_mode_ranges)), "", TeeOutput.onlyDisplay, True)
             line_num += 1
         global lastPrinted
         lastPrinted = p
@@ -704,24 +818,27 @@ def data_received_callback_a(data):
 
 
 def data_received_callback_b(data):
-    data_received_callback(list(data), "B")
+    data_received_callback(data, "B")
     return data
 
 def data_direction_str(inPort, outPort):
     return "%c -> %c: " % (inPort, outPort)
 
+# Format traffic for display, the same as joining 'hexByteStrs' for each byte but with bytes.hex()
+# doing the work ("01 02 .." -> "0x01 0x02 ..").
+def data_hex_str(data):
+    if not data:
+        return ""
+    return "0x" + data.hex(" ").replace(" ", " 0x") + " "
+
 lastPrinted = "None"
-portDataOutBuffer = {}
-delimMatched = {}
 bytesOnLine = 0
 
 
 def data_received_callback(data, p):
     # When matching on start/stop message delimiters, we'll buffer the data in case
     # there are replacements/substitutions to make...
-    global delimMatched
     global lastPrinted
-    global portDataOutBuffer
     global bytesOnLine
     global watchingStarted
     global captureStarted
@@ -734,9 +851,15 @@ def data_received_callback(data, p):
         outp = "A"
         out_dev_id = serial_processor.DeviceIdentifier.ALPHA
 
+    state = portStates[p]
+
     # Acquire lock for writing to the "output port"
     with writerLock[outp]:
         if len(data) > 0:
+            if not delimMatching:
+                # No message buffering needed, so forward the data along to the other port
+                # right away rather than after formatting it all for display...
+                processor.write(out_dev_id, bytes(data))
             if lastPrinted != p:
                 # Last data we printed was from the other port, print our current port source.
                 if lastPrinted != "None":
@@ -756,48 +879,109 @@ def data_received_callback(data, p):
                     # to the terminal output...
                     tee(data_direction_str(p, outp), "", TeeOutput.onlyFile)
                     captureStarted = False
-                if len(delimMatched[p]["end"]) > 0:
+                if len(state.matched_end) > 0:
                     # The previous byte we looked at matched an end-of-message delim, go to new line.
                     tee()
                     tee("        ", "")
                     bytesOnLine = 0
-            delimMatched[p]["start"] = ""
-            delimMatched[p]["end"] = ""
-            for b in data:
-                # Check if each incoming byte makes a start-of-message delim match.
-                delimMatched[p]["start"] = check_msg(p, "start", b)
-                if len(delimMatched[p]["start"]) > 0:
-                    portDataOutBuffer[outp].append(b)
-                    # We did match a start-of-message delim.
-                    if len(delimMatched[p]["start"]) > 1:
-                        # It was a multi-byte start-of-message delim, so remove previous data bytes
-                        # that we had already printed.
-                        tee("\b" * 5 * (len(delimMatched[p]["start"]) - 1), "")
-                    if bytesOnLine >= len(delimMatched[p]["start"]):
-                        # Need to erase and go to a new line now (also indent!)
-                        tee(" " * 5 * (len(delimMatched[p]["start"]) - 1), "")
-                        tee()
-                        tee("        ", "")
-                    tee(" ".join(format("0x%02x" % int(n, 16)) for n in delimMatched[p]["start"]) + " ", "")
-                    bytesOnLine = len(delimMatched[p]["start"])
-                    # Send the buffered message out the correct port and reset the databuffer...
-                    last_data_index = len(portDataOutBuffer[outp]) - len(delimMatched[p]["start"])
-                    processor.write(out_dev_id, bytes(portDataOutBuffer[outp][:last_data_index]))
-                    portDataOutBuffer[outp] = [int(n, 16) for n in delimMatched[p]["start"]]
-                else:
-                    # Data byte wasn't a start-of-message delim match, check if end-of-message delim...
-                    delimMatched[p]["end"] = check_msg(p, "end")
-                    tee("0x%02x " % b, "")
-                    bytesOnLine += 1
-                    if delimMatching:
-                        portDataOutBuffer[outp].append(b)
-                    if len(delimMatched[p]["end"]) > 0:
+            state.matched_end = b""
+            if not delimMatching:
+                # No delims to look for, so the whole chunk is just data to display.
+                bytesOnLine += len(data)
+                tee(data_hex_str(data), "", TeeOutput.both, True)
+                return
+            # Display/capture output for this chunk, written out in one go at the end.
+            pending = []
+            # Look these up once per chunk rather than once per byte/run of data below.
+            hex_strs = hexByteStrs
+            write = processor.write
+            delim_regex = delimRegex
+            buffer_max = checkMsgBufferMax
+            start_delims = msgDelimsPatterns["start"]
+            end_delims = msgDelimsPatterns["end"]
+            data_len = len(data)
+            # End-of-message delim matched by the last byte checked, kept locally until this chunk is done.
+            matched_end = b""
+            # A delimiter can only complete from where the delimiter regex next matches (searching from the
+            # start of the port's message buffer), so everything ahead of that is plain data to handle in bulk.
+            # With only single-byte delims, that's simply the next delim byte.
+            if delimByteMarks:
+                marks = data.translate(delimByteMarks)
+            else:
+                # Only the last (longest delim - 1) buffered bytes can be part of a delim completing in this
+                # chunk, so that's all that needs searching ahead of it.
+                max_lookback = max(buffer_max - 1, 0)
+                tail = state.msg_buffer[max(len(state.msg_buffer) - max_lookback, 0):]
+                buffered_len = len(tail)
+                search_data = bytes(tail) + data if tail else data
+            pos = 0
+            while pos < data_len:
+                # Start and end (in 'data') of the next possible match.
+                match = None
+                if delimByteMarks:
+                    found = marks.find(1, pos)
+                    if found >= 0:
+                        match = (found, found + 1)
+                elif delim_regex:
+                    # Search from the start of the message buffer, but never from further back than a delim
+                    # completing at 'pos' could start (anything before that has already been checked).
+                    found = delim_regex.search(
+                        search_data,
+                        max(buffered_len + pos - len(state.msg_buffer), buffered_len + pos - max_lookback, 0))
+                    if found:
+                        match = (found.start() - buffered_len, found.end() - buffered_len)
+                plain_end = data_len if match is None else max(match[0], pos)
+                if plain_end > pos:
+                    plain = data[pos:plain_end]
+                    if buffer_max > 0:
+                        state.msg_buffer.extend(plain)
+                        if len(state.msg_buffer) >= 2 * buffer_max:
+                            del state.msg_buffer[:-buffer_max]
+                    matched_end = b""
+                    pending.append(data_hex_str(plain))
+                    bytesOnLine += len(plain)
+                    state.out_buffer.extend(plain)
+                    pos = plain_end
+                if match is None:
+                    break
+                # Possible delimiter match, check it byte-by-byte...
+                match_end = max(match[1], pos + 1)
+                for b in data[pos:match_end]:
+                    # Check if each incoming byte makes a start-of-message (or end-of-message) delim match.
+                    matched_start, end_delim = check_msg(state, b, start_delims, end_delims)
+                    if len(matched_start) > 0:
+                        state.out_buffer.append(b)
+                        # We did match a start-of-message delim.
+                        if len(matched_start) > 1:
+                            # It was a multi-byte start-of-message delim, so remove previous data bytes
+                            # that we had already printed.
+                            pending.append("\b" * 5 * (len(matched_start) - 1))
+                        if bytesOnLine >= len(matched_start):
+                            # Need to erase and go to a new line now (also indent!)
+                            pending.append(" " * 5 * (len(matched_start) - 1))
+                            pending.append("\n        ")
+                        pending.append(msgDelimsDisplay["start"][matched_start] + " ")
+                        bytesOnLine = len(matched_start)
                         # Send the buffered message out the correct port and reset the databuffer...
-                        processor.write(out_dev_id, bytes(portDataOutBuffer[outp]))
-                        portDataOutBuffer[outp] = []
-                if not delimMatching:
-                    # Send byte along to the other port now...
-                    processor.write(out_dev_id, b.to_bytes(1, byteorder='big'))
+                        # (The buffer is handed over as it is rather than copied, it's replaced here anyway.)
+                        last_data_index = len(state.out_buffer) - len(matched_start)
+                        del state.out_buffer[last_data_index:]
+                        write(out_dev_id, state.out_buffer)
+                        state.out_buffer = bytearray(matched_start)
+                    else:
+                        # Data byte wasn't a start-of-message delim match, but may be an end-of-message delim...
+                        matched_end = end_delim
+                        pending.append(hex_strs[b])
+                        bytesOnLine += 1
+                        state.out_buffer.append(b)
+                        if len(matched_end) > 0:
+                            # Send the buffered message out the correct port and reset the databuffer...
+                            write(out_dev_id, state.out_buffer)
+                            state.out_buffer = bytearray()
+                pos = match_end
+            state.matched_end = matched_end
+            # Output isn't flushed per byte, push out everything from this chunk at once.
+            tee("".join(pending), "", TeeOutput.both, True)
 
 
 processor = None
@@ -824,18 +1008,8 @@ def start_traffic(args=""):
         # Something failed in our open+settings attempt, bail out...
         return
 
-    global portDataOutBuffer
-    if delimMatching:
-        portDataOutBuffer = {}
-
-    global delimMatched
-    delimMatched = {}
     for p in ["A", "B"]:
-        delimMatched[p] = {}
-        delimMatched[p]["start"] = ""
-        delimMatched[p]["end"] = ""
-        if delimMatching:
-            portDataOutBuffer[p] = []
+        portStates[p] = PortState()
 
     conf_a = {
         'device': portSettings["A"]["dev"],
@@ -883,8 +1057,20 @@ def stop_traffic(args=""):
 
 
 def watch_wait_exit():
-    while watching:
-        sleep(.25)
+    # Traffic display output is flushed once per received chunk (see tee()), so while watching, stop
+    # stdout from also flushing at every newline it's given, as it does when it's a terminal.
+    line_buffering = getattr(sys.stdout, "line_buffering", False)
+    if line_buffering:
+        with teeLock:
+            sys.stdout.reconfigure(line_buffering=False)
+    try:
+        # Sleep until CTRL-C exits watch mode (see ProxyRepl.onecmd()).
+        while watching:
+            watchExited.wait()
+    finally:
+        if line_buffering:
+            with teeLock:
+                sys.stdout.reconfigure(line_buffering=True)
 
 
 def watch(args=""):
@@ -896,6 +1082,7 @@ def watch(args=""):
     global watchingStarted
     print("Watching data passed between ports. Press CTRL-C to stop...")
     watching = watchingStarted = True
+    watchExited.clear()
 
 
 # 'textmodeget' command, allows user to output the current terminal text mode
@@ -938,7 +1125,9 @@ def shutdown():
         processor.stop()
     if captureFile:
         # Close our existing capture...
-        captureFile.close()
+        with teeLock:
+            capture_flush()
+            captureFile.close()
 
 
 # Implementation of our REPL functionality.
@@ -962,6 +1151,7 @@ class ProxyRepl(cmd.Cmd):
             if watching:
                 # stop watching
                 watching = watchingStarted = False
+                watchExited.set()
                 self.stdout.write("\nWatch mode exited.\n")
                 # don't stop interpretation of commands by the interpreter
                 return False
@@ -1187,9 +1377,7 @@ Example(s): textmodeset replaced invert
         shutdown()
         return True
 
-    def do_quit(self, arg):
-        shutdown()
-        return True
+    do_quit = do_exit
 
     def emptyline(self):
         pass
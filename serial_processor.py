@@ -1,12 +1,28 @@
 #!/usr/bin/env python
 import argparse
+import array
 import logging
+import os
+import select
+import selectors
 import sys
+import threading
 from enum import Enum
+from queue import Empty, Full, Queue
 
 import serial
 import serial.threaded
 
+try:
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = termios = None
+
+# Linux serial_struct flag asking the driver (e.g. FTDI USB-serial) not to hold received data back
+# to batch it up.
+ASYNC_LOW_LATENCY = 0x2000
+
 
 class DeviceIdentifier(Enum):
     ALPHA = 1
@@ -71,17 +87,24 @@ class ProxyProtocol(serial.threaded.Protocol):
         Parameters:
             data (bytes) - received bytes
         """
-        self.logger.debug(f"[{self.dev_id.name}] data_received: len={len(data)}, data={data}")
+        # This runs for every chunk read, so skip building the (data-formatting) debug messages
+        # entirely unless they'll actually be logged.
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.debug(f"[{self.dev_id.name}] data_received: len={len(data)}, data={data}")
         # super().data_received(data)
         if self.data_received_callback:
-            self.logger.debug(f"[{self.dev_id.name}] calling data received callback")
+            if debug:
+                self.logger.debug(f"[{self.dev_id.name}] calling data received callback")
             data = self.data_received_callback(data)
-            self.logger.debug(f"[{self.dev_id.name}] returned from data received callback; "
-                              f"len={len(data)}, data={data}")
+            if debug:
+                self.logger.debug(f"[{self.dev_id.name}] returned from data received callback; "
+                                  f"len={len(data)}, data={data}")
 
         if self.pass_through and self.data_pass_through_callback:
             # pass-through data
-            self.logger.debug(f"[{self.dev_id.name}] data_received: calling data pass-through callback >>>")
+            if debug:
+                self.logger.debug(f"[{self.dev_id.name}] data_received: calling data pass-through callback >>>")
             self.data_pass_through_callback(self.dev_id, data)
 
     def connection_lost(self, exc):
@@ -96,7 +119,102 @@ class ProxyProtocol(serial.threaded.Protocol):
             self.logger.exception(f"[{self.dev_id.name}] connection_lost: exception")
 
 
+class ProxyReaderThread(serial.threaded.ReaderThread):
+    """
+    Reader thread that, on POSIX systems, waits on and reads from the serial port's file
+    descriptor directly rather than going through pySerial's read() and its per-call
+    timeout bookkeeping.
+    """
+
+    # Most bytes taken per read; the tty layer only buffers 4 KiB per port anyway.
+    read_size = 4096
+
+    def run(self):
+        """Reader loop"""
+        if not hasattr(self.serial, 'fd') or not hasattr(self.serial, 'pipe_abort_read_r'):
+            # Not a POSIX serial port, fall back to pySerial's reader loop.
+            super().run()
+            return
+
+        self.protocol = self.protocol_factory()
+        try:
+            self.protocol.connection_made(self)
+        except Exception as e:
+            self.alive = False
+            self.protocol.connection_lost(e)
+            self._connection_made.set()
+            return
+        error = None
+        self._connection_made.set()
+        fd = self.serial.fd
+        abort_fd = self.serial.pipe_abort_read_r
+        # Register the fds once up front (epoll on Linux), rather than handing them over on every wait.
+        selector = selectors.DefaultSelector()
+        selector.register(fd, selectors.EVENT_READ)
+        selector.register(abort_fd, selectors.EVENT_READ)
+        while self.alive and self.serial.is_open:
+            try:
+                # Sleep until there's data to read, or stop() cancels the read.
+                ready = [key.fd for key, _ in selector.select()]
+                if abort_fd in ready:
+                    os.read(abort_fd, 1000)
+                    continue
+                # Drain everything pending in one read, no need to ask how much there is first.
+                data = os.read(fd, self.read_size)
+                if not data:
+                    # Disconnected devices can report readiness but return no data.
+                    raise serial.SerialException('device reports readiness to read but returned no data '
+                                                 '(device disconnected or multiple access on port?)')
+            except BlockingIOError:
+                continue
+            except (OSError, serial.SerialException) as e:
+                # probably some I/O problem such as disconnected USB serial adapters -> exit
+                error = e
+                break
+            # make a separated try-except for called used code
+            try:
+                self.protocol.data_received(data)
+            except Exception as e:
+                error = e
+                break
+        selector.close()
+        self.alive = False
+        self.protocol.connection_lost(error)
+        self.protocol = None
+
+    def write(self, data):
+        """Thread safe writing (uses lock)"""
+        data = memoryview(data)
+        while True:
+            with self._lock:
+                if not self.serial.is_open:
+                    raise serial.portNotOpenError
+                if not hasattr(self.serial, 'fd'):
+                    self.serial.write(data)
+                    return
+                # The port can usually take the whole chunk straight away, so write it to the fd directly
+                # and only wait for room for whatever didn't fit.
+                try:
+                    data = data[os.write(self.serial.fd, data):]
+                except BlockingIOError:
+                    pass
+                if not data:
+                    return
+                fd = self.serial.fd
+                abort_fd = self.serial.pipe_abort_write_r
+            # Wait without holding the lock, so a device that's stopped taking data doesn't hold up
+            # close() too, and give up on the rest if cancel_write() is called.
+            abort, _, _ = select.select([abort_fd], [fd], [])
+            if abort:
+                os.read(abort_fd, 1000)
+                return
+
+
 class SerialProcessor:
+    # Most chunks of data waiting to be written to a device before reading from the other device waits
+    # for it to catch up (e.g. when it runs at a lower baud rate), rather than queueing up without limit.
+    write_queue_max = 64
+
     def __init__(self, conf_a, conf_b):
         super().__init__()
         self.thread_a = None
@@ -107,6 +225,12 @@ class SerialProcessor:
         self.protocol_b = None
         self.conf_a = conf_a
         self.conf_b = conf_b
+        # Data waiting to be written to each device, and the threads writing it out, so that a device
+        # that's slow to take data doesn't hold up reading from the other one.
+        self.write_queue_a = Queue(self.write_queue_max)
+        self.write_queue_b = Queue(self.write_queue_max)
+        self.writer_a = None
+        self.writer_b = None
         self.logger = logging.getLogger('SerialProcessor')
 
         self.ser_a = serial.Serial(
@@ -127,36 +251,61 @@ class SerialProcessor:
             timeout=self.conf_b['timeout'],
         )
 
-        self.ser_a.flushInput()
-        self.ser_b.flushInput()
+        self.ser_a.reset_input_buffer()
+        self.ser_b.reset_input_buffer()
+        self.set_low_latency(self.ser_a)
+        self.set_low_latency(self.ser_b)
         self.logger.debug(f"conf_a={self.conf_a}, conf_b={self.conf_b}")
         self.logger.info(f"{DeviceIdentifier.ALPHA.name} device: {self.conf_a['device']}")
         self.logger.info(f"{DeviceIdentifier.BETA.name} device: {self.conf_b['device']}")
 
+    def set_low_latency(self, ser):
+        """Put the serial device in low latency mode, if it supports it."""
+        if not hasattr(termios, 'TIOCGSERIAL') or not hasattr(ser, 'fd'):
+            return
+        try:
+            buf = array.array('i', [0] * 32)
+            fcntl.ioctl(ser.fd, termios.TIOCGSERIAL, buf)
+            # serial_struct.flags
+            buf[4] |= ASYNC_LOW_LATENCY
+            fcntl.ioctl(ser.fd, termios.TIOCSSERIAL, buf)
+        except OSError as e:
+            # Plenty of devices (ptys, some USB adapters) don't have serial_struct settings.
+            self.logger.debug(f"set_low_latency: {ser.port} not set to low latency mode: {e}")
+
     def start(self):
-        """Start the reader threads."""
+        """Start the reader and writer threads."""
         self.logger.info(f"starting reader threads")
 
-        self.thread_a = serial.threaded.ReaderThread(
+        self.thread_a = ProxyReaderThread(
             self.ser_a,
             ProxyProtocolFactory(
                 DeviceIdentifier.ALPHA,
                 pass_through=self.conf_a['pass_through'],
                 data_pass_through_callback=self.data_pass_through,
                 data_received_callback=self.conf_a['data_received_callback']).create_proxy_protocol)
-        # Start the thread’s activity
-        self.thread_a.start()
-        self.transport_a, self.protocol_a = self.thread_a.connect()
-        self.logger.debug(f"thread_a={self.thread_a}, transport_a={self.transport_a}, "
-                          f"protocol_a={self.protocol_a}")
-
-        self.thread_b = serial.threaded.ReaderThread(
+        self.thread_b = ProxyReaderThread(
             self.ser_b,
             ProxyProtocolFactory(
                 DeviceIdentifier.BETA,
                 pass_through=self.conf_b['pass_through'],
                 data_pass_through_callback=self.data_pass_through,
                 data_received_callback=self.conf_b['data_received_callback']).create_proxy_protocol)
+
+        # The writers have to be running before either reader starts handing them data.
+        self.writer_a = threading.Thread(
+            target=self.writer, args=(DeviceIdentifier.ALPHA, self.thread_a, self.write_queue_a), daemon=True)
+        self.writer_a.start()
+        self.writer_b = threading.Thread(
+            target=self.writer, args=(DeviceIdentifier.BETA, self.thread_b, self.write_queue_b), daemon=True)
+        self.writer_b.start()
+
+        # Start the thread’s activity
+        self.thread_a.start()
+        self.transport_a, self.protocol_a = self.thread_a.connect()
+        self.logger.debug(f"thread_a={self.thread_a}, transport_a={self.transport_a}, "
+                          f"protocol_a={self.protocol_a}")
+
         # Start the thread’s activity
         self.thread_b.start()
         self.transport_b, self.protocol_b = self.thread_b.connect()
@@ -164,27 +313,75 @@ class SerialProcessor:
                           f"protocol_b={self.protocol_b}")
 
     def stop(self):
-        """Stop the reader threads."""
+        """Stop the reader and writer threads."""
         self.logger.info(f"closing reader threads")
+        # Stop reading first, then let the writers finish off what's already been queued before closing
+        # the ports.
+        self.thread_a.stop()
+        self.thread_b.stop()
+        for queue in (self.write_queue_a, self.write_queue_b):
+            try:
+                queue.put(None, timeout=2)
+            except Full:
+                # Dealt with below, once the writer's had its chance to finish.
+                pass
+        self.writer_a.join(2)
+        self.writer_b.join(2)
+        # A writer still going is waiting on a device that isn't taking data (fast enough), so throw away
+        # what's left and cancel the write it's waiting on.
+        for ser, queue, writer in ((self.ser_a, self.write_queue_a, self.writer_a),
+                                   (self.ser_b, self.write_queue_b, self.writer_b)):
+            if writer.is_alive():
+                self.logger.error(f"stop: writer thread for {ser.port} not keeping up, closing port anyway")
+                self.discard_queued(queue)
+                queue.put_nowait(None)
+                ser.cancel_write()
+                writer.join(2)
         self.thread_a.close()
         self.thread_b.close()
+        # Anything a writer that didn't finish in time still has queued can't be written now.
+        for queue in (self.write_queue_a, self.write_queue_b):
+            self.discard_queued(queue)
+            queue.put_nowait(None)
+
+    @staticmethod
+    def discard_queued(queue):
+        """Throw away everything waiting in a write queue."""
+        try:
+            while True:
+                queue.get_nowait()
+        except Empty:
+            pass
+
+    def writer(self, device_id, thread, queue):
+        """Writer thread loop, writes queued data to a device until a None is queued."""
+        for data in iter(queue.get, None):
+            try:
+                thread.write(data)
+            except (OSError, serial.SerialException):
+                if not thread.serial.is_open:
+                    # Closed by stop() while this was still writing, drop whatever's left.
+                    continue
+                self.logger.exception(f"[{device_id.name}] writer: exception")
 
     def write(self, device_id, data):
         """Write data to the device identified by device_id."""
-        self.logger.info(f"write: device_id={device_id}, data={data}")
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(f"write: device_id={device_id}, data={data}")
         if device_id == DeviceIdentifier.ALPHA:
-            self.thread_a.write(data)
+            self.write_queue_a.put(data)
         elif device_id == DeviceIdentifier.BETA:
-            self.thread_b.write(data)
+            self.write_queue_b.put(data)
         else:
             self.logger.error(f"write: unknown device identifier '{device_id}'")
 
     def data_pass_through(self, device_id, data):
-        self.logger.debug(f"data_pass_through: device_id={device_id}, data={data}")
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"data_pass_through: device_id={device_id}, data={data}")
         if device_id == DeviceIdentifier.ALPHA:
-            self.thread_b.write(data)
+            self.write_queue_b.put(data)
         elif device_id == DeviceIdentifier.BETA:
-            self.thread_a.write(data)
+            self.write_queue_a.put(data)
         else:
             self.logger.error(f"data_pass_through: unknown device identifier '{device_id}'")
             return False